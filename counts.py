@@ -1,28 +1,45 @@
 """Quantify the horniness of ships.
 
 Counts total fics and number of explicit fics for 1176 possible pairings, including characters with themselves.
-To stay within AO3's rate limit for automated access, there is a 5-second pause between counts.
+To stay within AO3's rate limit for automated access, requests are paced at most one every 5 seconds.
 So this script will take quite a long time to run.
 
 Character list is read from 'names.txt'.
 
+Counts are cached by user and relationship tag in 'cache.sqlite', so reruns only query new ships or ones older than the cache TTL.
+AO3 pages are also cached for 12 hours in 'ao3_cache.sqlite' (or 'ao3_cache.<username>.sqlite' when logged in).
+
 Results are saved to 'ships.csv' with columns:
     A: character name
     B: character name
     ship: slash-format ship name
+    tag: canonical AO3 relationship tag
     fics: number of fics found
-    explicit: number of explicit fics found
+    explicit: number of explicit fics found (empty if skipped, see --min-for-explicit)
     p: proportion of fics that are explicit
+
+Results are also written to 'ships.partial.csv' as they come in, which is moved to 'ships.csv' once all ships are counted.
+So an aborted run leaves its incomplete results in 'ships.partial.csv'.
 """
 
-import itertools
+import argparse
+import concurrent.futures
 import os
+import re
+import socket
+import sqlite3
+import sys
+import threading
 import time
+import urllib.parse
 
-import bs4
+import lxml.etree
+import lxml.html
+import numpy
 import pandas
-import regex
 import requests
+import requests_cache
+import urllib3.connection
 
 
 username = os.environ.get('AO3_USERNAME')
@@ -30,20 +47,56 @@ password = os.environ.get('AO3_PASSWORD')
 
 # NOTE: Set a very conservative sleep period to avoid AO3's rate limiting.
 sleep_period = 5
-backoff_factor = 60
+max_backoff = 120
+max_rate_limited_attempts = 7
+
+# NOTE: The adapter only retries dropped connections and read errors, 429s are handled by the rate limiter
+max_network_retries = 5
+network_backoff_factor = 2
+
+# NOTE: Workers overlap network latency with the pause between requests, the limiter still sets the overall pace.
+n_workers = 4
+request_timeout = 30
+chunk_size = 8192
+
+# NOTE: TCP keepalive stops idle pooled connections being dropped while workers wait on the limiter or back off
+keepalive_socket_options = [
+    *urllib3.connection.HTTPConnection.default_socket_options,
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+if hasattr(socket, 'TCP_KEEPIDLE'):
+    keepalive_socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30))
+
+output_filename = 'ships.csv'
+partial_filename = 'ships.partial.csv'
+cache_filename = 'cache.sqlite'
+cache_ttl = 7 * 24 * 60 * 60
+http_cache_filename = 'ao3_cache.sqlite'
+user_http_cache_filename = 'ao3_cache.{}.sqlite'
+http_cache_ttl = 12 * 60 * 60
 
 login_url = 'https://archiveofourown.org/users/login'
 search_url = 'https://archiveofourown.org/works/search'
+tag_works_url = 'https://archiveofourown.org/tags/{}/works'
 search_field_ship = 'work_search[query]'
 search_field_rating = 'work_search[rating_ids]'
 explicit_rating_id = 13
 
-parser = 'lxml'
+work_count_pattern = re.compile(r'([\d,]+)')
+tag_work_count_pattern = re.compile(r'([\d,]+) Works? in')
+rating_count_pattern = re.compile(r'\(([\d,]+)\)')
 
-work_count_pattern = regex.compile('[0-9,]+')
+# NOTE: AO3 tag URLs use their own escapes for characters with special meaning in paths
+tag_url_escapes = {
+    '/': '*s*',
+    '&': '*a*',
+    '.': '*d*',
+    '?': '*q*',
+    '#': '*h*',
+}
 
 # NOTE: AO3's canonical tag for Vander now places him in League fandom, not Arcane
-champions = [
+champions = frozenset({
     'Caitlyn',
     'Ekko',
     'Heimerdinger',
@@ -53,12 +106,12 @@ champions = [
     'Vander',
     'Vi',
     'Viktor',
-]
+})
 
-special_case_names = [
+special_case_names = frozenset({
     'Brothel Girl',
     'Local Cuisine Guy',
-]
+})
 
 
 class LoginError(Exception):
@@ -69,6 +122,91 @@ class RateLimitedError(Exception):
     pass
 
 
+class RateLimiter:
+    """Token bucket for pacing requests to AO3.
+
+    Only waits for the residual interval since the last request,
+    so time spent on the request itself counts towards the pause.
+    Refill rate is halved on a 429 (down to one request per max_backoff seconds)
+    and recovers gradually afterwards, but never exceeds the initial (conservative) rate.
+    """
+
+    def __init__(self, capacity=1, refill_per_sec=1 / sleep_period, recovery=0.1):
+
+        self.capacity = capacity
+        self.max_refill_per_sec = refill_per_sec
+        self.min_refill_per_sec = min(refill_per_sec, 1 / max_backoff)
+        self.refill_per_sec = refill_per_sec
+        self.recovery = recovery
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_per_sec)
+        self.last_refill = now
+
+    def acquire(self):
+        """Wait until a request is allowed.
+
+        The token is reserved straight away (the bucket can go negative),
+        so other workers queue up behind it without the lock being held while waiting.
+        """
+
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+            wait = max(0, -self.tokens / self.refill_per_sec)
+
+        time.sleep(wait)
+
+    def succeeded(self):
+        """Additively restore the refill rate after a successful request.
+        """
+
+        with self.lock:
+            self.refill_per_sec = min(
+                self.max_refill_per_sec,
+                self.refill_per_sec + self.recovery * self.max_refill_per_sec
+            )
+
+    def rate_limited(self, retry_after=None):
+        """Multiplicatively slow down after a 429.
+
+        Drains the bucket, so the next request waits a full (slower) interval,
+        or at least as long as the server says if it sends Retry-After.
+        Returns how long the next request will wait, in seconds.
+        """
+
+        with self.lock:
+            self.refill()
+            self.refill_per_sec = max(self.min_refill_per_sec, self.refill_per_sec / 2)
+            self.tokens = min(self.tokens, 0, 1 - (retry_after or 0) * self.refill_per_sec)
+            return (1 - self.tokens) / self.refill_per_sec
+
+
+class KeepAliveAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter whose pooled connections use TCP keepalive.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+
+        kwargs['socket_options'] = keepalive_socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+def parse_retry_after(response):
+    """Read the Retry-After header of a response, in seconds.
+    """
+
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return None
+
+
 def wrangle_fandom_tag(name):
     """Determine the appropriate fandom tag for an Arcane character.
     
@@ -82,33 +220,26 @@ def wrangle_fandom_tag(name):
         return ' (Arcane: League of Legends)'
 
 
-def reverse_names(name):
-    """Helper function for reversing name order.
-    
-    i.e. switches first name and last name
-    """
-
-    if name in special_case_names:
-        return name
-    else:
-        names = name.split()
-        names.reverse()
-        return ' '.join(names)
+def tabulate_names(names):
+    """Tabulate the attributes of each name needed for wrangling relationship tags.
 
-
-def is_multiple_name(name):
-    """Helper function for counting names.
-    
-    i.e. does character have first name and family name?
+    sort_key: name with first name and last name switched, for ordering by last name
+    multiple: does character have first name and family name?
+    fandom: fandom disambiguation (see wrangle_fandom_tag)
     """
 
-    if name in special_case_names:
-        return False
-    else:
-        return len(name.split()) > 1
+    names = pandas.Series(names, index=names)
+    tokens = names.str.split()
+    special = names.isin(special_case_names)
+
+    return pandas.DataFrame({
+        'sort_key': tokens.str[::-1].str.join(' ').where(~special, names),
+        'multiple': tokens.str.len().gt(1) & ~special,
+        'fandom': names.map(wrangle_fandom_tag),
+    })
 
 
-def wrangle_relationship_tag(name1, name2):
+def wrangle_relationship_tag(name1, name2, name_table):
     """Determine the canonical relationship tag for a pairing.
 
     Follows AO3 wrangling guidelines for relationship and name tags:
@@ -119,20 +250,24 @@ def wrangle_relationship_tag(name1, name2):
     characters are from same fandom and at least one is double-name -> no fandom disambiguation
     characters are from same fandom and both are single-name -> overall fandom disambiguation at end of tag
     characters are from separate fandoms -> fandom disambiguation for any single-name characters
+
+    Name attributes are looked up in name_table (see tabulate_names).
     """
 
-    name1, name2 = sorted((name1, name2), key=reverse_names)
-    fandom1 = wrangle_fandom_tag(name1)
-    fandom2 = wrangle_fandom_tag(name2)
+    name1, name2 = sorted((name1, name2), key=name_table['sort_key'].get)
+    fandom1 = name_table.at[name1, 'fandom']
+    fandom2 = name_table.at[name2, 'fandom']
+    multiple1 = name_table.at[name1, 'multiple']
+    multiple2 = name_table.at[name2, 'multiple']
 
     if fandom1 == fandom2:
         fandom1 = ''
-        if is_multiple_name(name1) or is_multiple_name(name2):
+        if multiple1 or multiple2:
             fandom2 = ''
     else:
-        if is_multiple_name(name1):
+        if multiple1:
             fandom1 = ''
-        if is_multiple_name(name2):
+        if multiple2:
             fandom2 = ''
     
     return f'{name1}{fandom1}/{name2}{fandom2}'
@@ -142,9 +277,11 @@ def login(session, username, password):
     """Log in to AO3.
     """
 
-    response = session.get(login_url)
-    soup = bs4.BeautifulSoup(response.text, features=parser)
-    authenticity_token = soup.find('input', attrs={'name': 'authenticity_token'})['value']
+    with session.cache_disabled():
+        response = session.get(login_url, timeout=request_timeout)
+
+    tree = lxml.html.fromstring(response.content)
+    authenticity_token = tree.xpath('//input[@name="authenticity_token"]/@value')[0]
 
     params = {
         'user[login]': username,
@@ -152,7 +289,7 @@ def login(session, username, password):
         'authenticity_token': authenticity_token
     }
 
-    response = session.post(login_url, params=params, allow_redirects=False)
+    response = session.post(login_url, params=params, allow_redirects=False, timeout=request_timeout)
     
     if response.status_code != 302:
         raise LoginError('invalid username or password')
@@ -160,113 +297,379 @@ def login(session, username, password):
     return session
 
 
-def get_work_count(session, params):
+def warm_up(session, limiter):
+    """Open a connection to AO3 ahead of counting.
+
+    Pays for DNS lookup and TLS handshake up front (logging in does this too).
+    """
+
+    limiter.acquire()
+    with session.cache_disabled():
+        session.head(search_url, timeout=request_timeout)
+
+
+def get_page(session, limiter, url, params=None):
+    """Get a page from AO3, pacing requests with the rate limiter.
+
+    Pages in the session's HTTP cache are returned without waiting for the limiter.
+    A 429 slows down the limiter (for all workers) and tries again.
+    """
+
+    response = session.get(url, params=params, stream=True, only_if_cached=True)
+
+    if response.status_code != 504:
+        return response
+
+    for attempt in range(1, max_rate_limited_attempts + 1):
+        limiter.acquire()
+        response = session.get(url, params=params, timeout=request_timeout, stream=True)
+        if response.status_code != 429:
+            limiter.succeeded()
+            return response
+        response.close()
+        wait = limiter.rate_limited(parse_retry_after(response))
+        print(f'rate limited, backing off {wait:.0f}s (attempt {attempt} of {max_rate_limited_attempts})')
+
+    raise RateLimitedError(f'still rate limited after {max_rate_limited_attempts} attempts')
+
+
+def stream_elements(response):
+    """Parse a streamed response incrementally, yielding elements as they close.
+
+    Once the caller stops, the rest of the body is discarded without parsing,
+    so the connection can go back to the pool.
+    """
+
+    parser = lxml.etree.HTMLPullParser(events=('end',), encoding=response.encoding)
+
+    try:
+        for chunk in response.iter_content(chunk_size):
+            parser.feed(chunk)
+            for _, element in parser.read_events():
+                yield element
+        parser.close()
+        for _, element in parser.read_events():
+            yield element
+    finally:
+        response.raw.drain_conn()
+
+
+def is_main_div(element):
+    """Is the element the main content of an AO3 page?
+    """
+
+    return element.tag == 'div' and element.get('id') == 'main'
+
+
+def is_heading(element, tag):
+    """Is the element a heading within the main content of an AO3 page?
+    """
+
+    return (
+        element.tag == tag
+        and element.get('class') == 'heading'
+        and any(is_main_div(ancestor) for ancestor in element.iterancestors())
+    )
+
+
+def invalid_response(response):
+    """Report a page without main content.
+    """
+
+    print('\n[DEBUG] invalid response text but no rate limit warning in response\n')
+    print(response.status_code)
+
+    return RateLimitedError()
+
+
+def parse_count(text, pattern):
+    """Read a comma-separated count from text.
+
+    Returns None if there is no count in the text.
+    """
+
+    match = pattern.search(text)
+
+    if match:
+        return int(match.group(1).replace(',', ''))
+    else:
+        return None
+
+
+def get_work_count(session, limiter, params):
     """Get number of works for a search.
 
     Just reads the result count, doesn't check each work.
     """
 
-    response = session.get(search_url, params=params)
+    response = get_page(session, limiter, search_url, params=params)
+
+    for element in stream_elements(response):
+        if is_heading(element, 'h3'):
+            work_count = parse_count(''.join(element.itertext()), work_count_pattern)
+            if work_count is None:
+                break
+            return work_count
+        if is_main_div(element):
+            return 0
+
+    raise invalid_response(response)
+
+
+def open_cache(filename):
+    """Open the cache of work counts, creating it if needed.
+    """
+
+    cache = sqlite3.connect(filename)
+    # NOTE: With write-ahead logging, commits only need syncing at checkpoints, so storing each count stays cheap
+    cache.execute('PRAGMA journal_mode=WAL')
+    cache.execute('PRAGMA synchronous=NORMAL')
+    # NOTE: Counts are kept per user (empty for anonymous sessions) since anonymous sessions don't see all fics
+    cache.execute(
+        'CREATE TABLE IF NOT EXISTS user_counts'
+        ' (user TEXT, ship TEXT, total INT, explicit INT, fetched_at REAL, PRIMARY KEY (user, ship))'
+    )
+
+    return cache
 
-    if response.status_code == 429:
-        raise RateLimitedError(f'rate limited with sleep period {sleep_period}, try increasing')
 
-    soup = bs4.BeautifulSoup(response.text, features=parser)
-    main_div = soup.find('div', attrs={'id': 'main'})
+def get_cached_counts(cache, user, relationship_tag, ttl, min_for_explicit=0):
+    """Look up a user's cached work counts for a relationship tag.
+
+    Returns None if not cached or older than ttl seconds,
+    or if the explicit count was skipped but is needed for min_for_explicit.
+    """
 
-    if main_div is None:
-        print('\n[DEBUG] invalid response text but no rate limit warning in response\n')
-        print(response.status_code)
-        print(response.text)
-        raise RateLimitedError()
+    return cache.execute(
+        'SELECT total, explicit FROM user_counts WHERE user = ? AND ship = ? AND fetched_at > ?'
+        ' AND (explicit IS NOT NULL OR total < ?)',
+        (user, relationship_tag, time.time() - ttl, min_for_explicit)
+    ).fetchone()
 
-    header = main_div.find('h3', attrs={'class': 'heading'})
 
-    if header:
-        work_count = work_count_pattern.match(header.get_text()).group(0)
-        work_count = int(work_count.replace(',', ''))
+def cache_counts(cache, user, relationship_tag, total, explicit):
+    """Store a user's work counts for a relationship tag.
+    """
+
+    with cache:
+        cache.execute(
+            'INSERT OR REPLACE INTO user_counts VALUES (?, ?, ?, ?, ?)',
+            (user, relationship_tag, total, explicit, time.time())
+        )
+
+
+def get_tag_work_counts(session, limiter, tag):
+    """Get number of works and explicit works for a canonical tag.
+
+    Reads the total from the tag's works page header,
+    and the explicit count from the rating filter in the sidebar.
+    Returns None if the tag has no works page of its own (i.e. isn't canonical).
+    """
+
+    total = None
+    explicit = 0
+    explicit_label_id = f'include_work_search_rating_ids_{explicit_rating_id}'
+
+    escaped_tag = ''.join(tag_url_escapes.get(character, character) for character in tag)
+    url = tag_works_url.format(urllib.parse.quote(escaped_tag, safe=''))
+    response = get_page(session, limiter, url)
+
+    if response.status_code == 404:
+        response.close()
+        return None
+
+    for element in stream_elements(response):
+        if is_heading(element, 'h2'):
+            total = parse_count(''.join(element.itertext()), tag_work_count_pattern)
+        elif element.tag == 'label' and element.get('for') == explicit_label_id:
+            explicit = parse_count(''.join(element.itertext()), rating_count_pattern) or 0
+            break
+        elif is_main_div(element):
+            break
     else:
-        work_count = 0
+        raise invalid_response(response)
 
-    return work_count
+    if total is None:
+        return None
 
+    return total, explicit
+
+
+def checkpoint_counts(partial_file, ships, total, explicit):
+    """Append work counts for ships to a partial results file, flushed to disk straight away.
+    """
 
-def get_work_counts_for_ship(session, name1, name2):
+    p = explicit / total if total and explicit is not None else None
+    ships = ships.assign(fics=total, explicit=explicit, p=p)
+    ships.to_csv(partial_file, header=False, index=False)
+    partial_file.flush()
+    os.fsync(partial_file.fileno())
+
+
+def get_work_counts_for_ship(session, limiter, relationship_tag, min_for_explicit=0):
     """Get number of works and explicit works for a relationship.
 
-    Searches by canonical relationship tag (see wrangle_relationship_tag).
+    Uses the canonical relationship tag's works page (see wrangle_relationship_tag),
+    falling back to searching for the tag if it has no works page.
+    The fallback skips searching for explicit works (None) if there are fewer than min_for_explicit works in total.
     """
 
-    relationship_tag = wrangle_relationship_tag(name1, name2)
+    counts = get_tag_work_counts(session, limiter, relationship_tag)
+
+    if counts is not None:
+        return counts
+
     params = {search_field_ship: f'"{relationship_tag}"'}
-    total = get_work_count(session, params=params)
+    total = get_work_count(session, limiter, params=params)
 
-    if total:
-        time.sleep(sleep_period)
-        params[search_field_rating] = explicit_rating_id
-        explicit = get_work_count(session, params=params)
-    else:
+    if not total:
         explicit = 0
+    elif total < min_for_explicit:
+        explicit = None
+    else:
+        params[search_field_rating] = explicit_rating_id
+        explicit = get_work_count(session, limiter, params=params)
 
     return total, explicit
 
 
+def positive_int(value):
+    """Argument type for numbers that must be at least 1.
+    """
+
+    number = int(value)
+
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, got {number}')
+
+    return number
+
+
 if __name__ == '__main__':
 
+    argument_parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    argument_parser.add_argument(
+        '--min-for-explicit',
+        type=int,
+        default=0,
+        help='skip counting explicit fics for ships with fewer fics than this in total (default: count for all ships)'
+    )
+    argument_parser.add_argument(
+        '--workers',
+        type=positive_int,
+        default=n_workers,
+        help=f'number of ships to count concurrently, all sharing one rate limit (default: {n_workers})'
+    )
+    args = argument_parser.parse_args()
+
     with open('names.txt') as f:
         names = f.read().splitlines()
 
-    ships = pandas.DataFrame(
-        itertools.combinations_with_replacement(names, 2),
-        columns=['A', 'B']
+    names_array = numpy.array(names)
+    i, j = numpy.triu_indices(len(names_array))
+    ships = pandas.DataFrame({'A': names_array[i], 'B': names_array[j]})
+
+    ships['ship'] = ships['A'] + '/' + ships['B']
+    name_table = tabulate_names(names)
+    ships['tag'] = [wrangle_relationship_tag(a, b, name_table) for a, b in zip(ships['A'], ships['B'])]
+
+    user = username if username and password else ''
+    unique_tags = ships['tag'].drop_duplicates().tolist()
+    n_tags = len(unique_tags)
+    results = {}
+    limiter = RateLimiter()
+    cache = open_cache(cache_filename)
+
+    # NOTE: Pages are cached separately per user since anonymous sessions don't see all fics
+    session = requests_cache.CachedSession(
+        user_http_cache_filename.format(user) if user else http_cache_filename,
+        backend='sqlite',
+        expire_after=http_cache_ttl,
+        allowable_codes=(200, 404)
     )
-
-    ships['ship'] = ships['A'].str.cat(ships['B'], sep='/')
-
-    n_pairs = ships.shape[0]
-    totals = []
-    n_explicit = []
-    started = False
-
-    session = requests.Session()
     session.mount(
         'https://',
-        requests.adapters.HTTPAdapter(
+        KeepAliveAdapter(
+            pool_connections=1,
+            pool_maxsize=args.workers,
             max_retries=requests.adapters.Retry(
-                status=7,
-                status_forcelist=[429],
-                backoff_factor=backoff_factor
+                total=max_network_retries,
+                connect=max_network_retries,
+                read=max_network_retries,
+                status=0,
+                backoff_factor=network_backoff_factor,
+                respect_retry_after_header=False
             )
         )
     )
 
-    if username and password:
+    if user:
         session = login(session, username, password)
         print(f'logged in as {username}')
     else:
         print('anonymous user session, not all fics will be visible')
+        warm_up(session, limiter)
     
-    output_filename = 'ships.csv'
-
-    for a, b in zip(ships['A'], ships['B']):
-
-        if started:
-            time.sleep(sleep_period)
-        else:
-            started = True
-
-        try:
-            total, explicit = get_work_counts_for_ship(session, a, b)
-            totals.append(total)
-            n_explicit.append(explicit)
-            print(f'[{len(totals)} of {n_pairs}] {a}/{b}: {total} ({explicit} explicit)')
-        except RateLimitedError:
-            output_filename = 'temp.csv'
-            print('rate limited, aborting. incomplete results saved to \'temp.csv\'')
-            break
-    
-    ships['fics'] = totals
-    ships['explicit'] = n_explicit
-    ships['p'] = ships['explicit'] / ships['fics']
-
-    ships.to_csv(output_filename, index=False)
+    ships_by_tag = dict(tuple(ships.groupby('tag', sort=False)))
+
+    with open(partial_filename, 'w', newline='') as partial_file:
+
+        pandas.DataFrame(columns=[*ships.columns, 'fics', 'explicit', 'p']).to_csv(partial_file, index=False)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+
+            futures = {}
+
+            try:
+                for relationship_tag in unique_tags:
+                    cached = get_cached_counts(cache, user, relationship_tag, cache_ttl, args.min_for_explicit)
+                    if cached:
+                        results[relationship_tag] = cached
+                        checkpoint_counts(partial_file, ships_by_tag[relationship_tag], *cached)
+                    else:
+                        future = executor.submit(
+                            get_work_counts_for_ship,
+                            session,
+                            limiter,
+                            relationship_tag,
+                            args.min_for_explicit
+                        )
+                        futures[future] = relationship_tag
+
+                print(f'{len(results)} of {n_tags} relationship tags cached, {len(futures)} to count')
+
+                for future in concurrent.futures.as_completed(futures):
+                    relationship_tag = futures[future]
+                    total, explicit = future.result()
+                    cache_counts(cache, user, relationship_tag, total, explicit)
+                    checkpoint_counts(partial_file, ships_by_tag[relationship_tag], total, explicit)
+                    results[relationship_tag] = total, explicit
+                    print(f'[{len(results)} of {n_tags}] {relationship_tag}: {total} ({explicit} explicit)')
+            except (KeyboardInterrupt, Exception) as error:
+                executor.shutdown(wait=False, cancel_futures=True)
+                if isinstance(error, RateLimitedError):
+                    reason = 'rate limited'
+                elif isinstance(error, KeyboardInterrupt):
+                    reason = 'interrupted'
+                else:
+                    reason = f'failed ({type(error).__name__})'
+                print(f'{reason}, aborting. incomplete results saved to \'{partial_filename}\'')
+                # NOTE: Unexpected errors keep their traceback, every abort exits with a failure status
+                if not isinstance(error, (RateLimitedError, KeyboardInterrupt)):
+                    raise
+                sys.exit(1)
+
+    cache.close()
+
+    if len(results) == n_tags:
+
+        counts = pandas.DataFrame.from_dict(results, orient='index', columns=['fics', 'explicit'])
+        counts = counts.astype({'explicit': 'Int64'})
+        ships = ships.join(counts, on='tag')
+        ships['p'] = ships['explicit'] / ships['fics']
+
+        ships.to_csv(partial_filename, index=False)
+        os.replace(partial_filename, output_filename)
@@ -3,48 +3,46 @@
 
 import webbrowser
 
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot
 import pandas
-import plotnine
 
 
 n_ships = 20
 
 
-ships = pandas.read_csv('ships.csv')
+ships = (
+    pandas.read_csv(
+        'ships.csv',
+        usecols=['ship', 'fics', 'explicit', 'p'],
+        dtype={'fics': 'int32', 'explicit': 'Int32'}
+    )
+    .dropna()
+    .nlargest(n_ships, ['fics'], keep='all')
+    .sort_values(['p'])
+)
 
 ships['counts'] = ships['explicit'].astype(str) + '/' + ships['fics'].astype(str)
-ships = ships.dropna()
-ships = ships.nlargest(n_ships, ['fics'], keep='all')
-ships = ships.sort_values(['p'])
-ships['ship'] = pandas.Categorical(
+
+cmap = matplotlib.colormaps['Reds']
+norm = matplotlib.colors.Normalize(vmin=0, vmax=ships['p'].max())
+
+fig, ax = matplotlib.pyplot.subplots()
+bars = ax.barh(
     ships['ship'],
-    categories=ships['ship'].tolist()
+    ships['fics'],
+    color=cmap(norm(ships['p']))
 )
-
-fig = (
-    plotnine.ggplot(ships)
-    + plotnine.aes(
-        x='ship',
-        y='fics',
-        fill='p',
-        label='counts'
-    )
-    + plotnine.labs(
-        x='',
-        fill='thirst factor'
-    )
-    + plotnine.scale_y_continuous(
-        expand=(0.05, 0, 0.1, 0)
-    )
-    + plotnine.scale_fill_continuous(
-        cmap_name='Reds',
-        limits=(0, ships['p'].max())
-    )
-    + plotnine.geom_col()
-    + plotnine.geom_text()
-    + plotnine.coord_flip()
+ax.bar_label(bars, labels=ships['counts'], padding=2)
+ax.set_xlim(0, ships['fics'].max() * 1.25)
+ax.set_xlabel('fics')
+fig.colorbar(
+    matplotlib.cm.ScalarMappable(norm=norm, cmap=cmap),
+    ax=ax,
+    label='thirst factor'
 )
 
 fig_filename = 'fig.png'
-fig.save(fig_filename)
+fig.savefig(fig_filename, dpi=110, bbox_inches='tight')
 webbrowser.open(fig_filename)